@@ -5,18 +5,125 @@ import warnings
 from IPython import embed
 import glob
 import numpy as np
-import dateutil.parser
+from datetime import datetime
 from . import utils
 import cv2
-import os,shutil
+import functools
+import pathlib
+import subprocess
+import threading
+import queue
 try:
     from pupil_tracking.pupil_tracker_aod import PupilTracker
 except ImportError:
     warnings.warn("Failed to import pupil_tacking library. You won't be able to populate trk.EyeFrame")
+try:
+    from video_reader import PyVideoReader
+except ImportError:
+    PyVideoReader = None  # fall back to cv2.VideoCapture
 
 schema = dj.schema('pipeline_aod_pupiltracking', locals())
 
 
+class _CvVideoReader:
+    """ cv2.VideoCapture with the get_batch() interface of video_reader.PyVideoReader."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_batch(self, indices):
+        """ Returns the frames at the requested (0-based) indices as BGR images.
+
+        Frames in between are only grabbed (demuxed), not decoded.
+        """
+        frames = {}
+        cap = cv2.VideoCapture(self.path)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # no read-ahead queue, frames are fetched sparsely
+        fr_count = -1  # index of the last grabbed frame
+        for index in sorted(set(indices)):
+            while fr_count < index and cap.grab():
+                fr_count += 1
+            if fr_count < index:
+                break  # video is shorter than requested
+            ret, frames[index] = cap.retrieve()
+        cap.release()
+        return [frames.get(i) for i in indices]
+
+
+class _RustVideoReader:
+    """ video_reader.PyVideoReader returning BGR frames, like cv2 does."""
+
+    def __init__(self, path):
+        self.reader = PyVideoReader(path, threads=8)
+
+    def get_batch(self, indices):
+        return [frame[:, :, ::-1] for frame in self.reader.get_batch(list(indices))]
+
+
+def _read_sampled_frames(cap, length_video, frames, every=6, stop=None):
+    """ Puts (frame number, frame) for every n-th frame of cap in the frames queue.
+
+    Frames in between are only grabbed, not decoded. The last 10 frames of the video
+    are skipped. None is put at the end, also when the video ends early or reading fails
+    (the exception is put right before it, for the consumer to re-raise). Returns as soon
+    as stop (a threading.Event) is set, even if the queue is full.
+    """
+    stop = threading.Event() if stop is None else stop
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return
+            except queue.Full:  # consumer is behind (or gone), check stop again
+                pass
+
+    try:
+        fr_count = 0
+        while fr_count + 1 < length_video - 10 and not stop.is_set():
+            fr_count += 1
+            if fr_count % 1000 == 0:
+                print("Processing frame = ", fr_count, "/", length_video)
+            if fr_count % every != 0:
+                if not cap.grab():  # advance without decoding
+                    break
+                continue
+            ret, frame = cap.read()
+            if not ret:
+                break
+            put((fr_count, frame))
+    except Exception as error:  # e.g. corrupt container or decoder error
+        put(error)
+    finally:
+        put(None)
+
+
+_session_folders = {}  # mouse folder -> (session folders, start times), both sorted by time
+
+
+def _get_session_folders(mouse, time):
+    """ Returns the session folders of a mouse and their start times, sorted by time.
+
+    Cached per mouse; reread from disk when time is after the latest cached session.
+    """
+    cached_times = _session_folders.get(mouse, (None, []))[1]
+    if len(cached_times) == 0 or time > cached_times[-1]:
+        folders = glob.glob(r"/m/Mouse/{f1}/20*".format(f1=mouse))
+        names = [pathlib.PurePath(name).name for name in folders]
+        times = pd.to_datetime(['_'.join(name.split('_')[:2]) for name in names],  # ignore suffixes
+                               format='%Y-%m-%d_%H-%M-%S').values
+        order = np.argsort(times)
+        _session_folders[mouse] = ([folders[k] for k in order], times[order])
+    return _session_folders[mouse]
+
+
+def _open_video(path):
+    """ Opens a video for random frame access, using video_reader if it is installed."""
+    if PyVideoReader is not None:
+        return _RustVideoReader(path)
+    return _CvVideoReader(path)
+
+
 @schema
 class TrackInfo(dj.Imported):
     definition = """
@@ -31,34 +138,14 @@ class TrackInfo(dj.Imported):
         print("key = ", key)
         # embed()
         path = (aodpre.Scan() & key).fetch1['hdf5_file']
-        path.replace('\\', '/')
-
-        # words = path.split('\\')
-        # if len(words) == 1:
-
-        words = words[0].split('/')
+        words = pathlib.PureWindowsPath(path).parts  # splits windows and posix paths
         i = words.index('Mouse')
-        ymd = words[i + 3].split('_')[0]
-        hms = words[i + 3].split('_')[1].replace("-", ":")
-        time_hdf5 = dateutil.parser.parse("{ymd} {hms}".format(ymd=ymd, hms=hms))
-
-        # time_str = words[i+3].split('_')[1].split('-')
-        # time_hdf5 = int(time_str[0])*10000 + int(time_str[1])*100 + int(time_str[2])
-        folders = glob.glob(r"/m/Mouse/{f1}/20*".format(f1=words[i + 1]))
-        time_coll = []
-        time_diff = []
-        for name in folders:
-            ymd = name.split('/')[4].split('_')[0]
-            hms = name.split('/')[4].split('_')[1].replace("-", ":")
-            # t = name.split('/')[-1].split('_')[1].split('-')
-            # time = int(t[0])*10000 + int(t[1])*100 + int(t[2])
-            time = dateutil.parser.parse("{ymd} {hms}".format(ymd=ymd, hms=hms))
-            time_coll.append(time)
-            diff = abs((time_hdf5 - time).total_seconds())
-            time_diff.append(diff)
-
-        time_diff = np.asarray(time_diff)
-        fo = folders[np.argmin(abs(time_diff))]
+        time_str = '_'.join(words[i + 3].split('_')[:2])  # YYYY-MM-DD_HH-MM-SS
+        time_hdf5 = np.datetime64(datetime.strptime(time_str, '%Y-%m-%d_%H-%M-%S'))
+        folders, folder_times = _get_session_folders(words[i + 1], time_hdf5)
+        j = np.searchsorted(folder_times, time_hdf5)
+        neighbours = [k for k in (j - 1, j) if 0 <= k < len(folders)]
+        fo = folders[min(neighbours, key=lambda k: abs(folder_times[k] - time_hdf5))]
         avi_path = glob.glob(r"{fo}/*.avi".format(fo=fo))
         assert len(avi_path) == 1, "Found 0 or more than 1 videos: {videos}".format(videos=str(avi_path))
         key['base_video_path'] = avi_path[0]
@@ -68,14 +155,7 @@ class TrackInfo(dj.Imported):
         # path = (aodpre.Scan() & key).fetch1['hdf5_file']
         video_file = (self & key).fetch1['base_video_path']
         # embed()
-        import cv2
-        cap = cv2.VideoCapture(video_file)
-        fr_count = 0
-        while cap.isOpened():
-            fr_count += 1
-            ret, frame = cap.read()
-            if fr_count == 1000:
-                return frame
+        return _open_video(video_file).get_batch([999])[0]
 
 
 @schema
@@ -90,9 +170,16 @@ class Roi(dj.Manual):
     y_roi_max                     : int                         # y coordinate of roi
     """
 
-    def dump_video(self):
+    def dump_video(self, codec='libx264', preset='ultrafast'):
+        """
+        Writes video_<mouse_id>_<scan_idx>.mp4 with every sixth frame and the detected pupil drawn on it.
+
+        :param codec: ffmpeg video encoder, e.g. h264_nvenc on hosts with an nvidia gpu
+        :param preset: encoder preset (ultrafast for libx264, p1 for h264_nvenc)
+        """
         print("Entered dump")
         vid_coll = self.fetch.as_dict()
+        encoders = []  # ffmpeg processes still flushing earlier videos
         for video in vid_coll:
             video_path = (TrackInfo() & video).fetch1['base_video_path']
             if not (EyeFrame() & video):
@@ -100,53 +187,59 @@ class Roi(dj.Manual):
                       ") not found. Please populate EyeFrame before dumping video")
             else:
                 print("Dumping video for parameters (mouse_id,scan_idx) = (", video['mouse_id'], video['scan_idx'], ")")
-                try:
-                    shutil.rmtree("temp_images")
-                except:
-                    pass
-                # print("Debug2")
-                os.makedirs("temp_images")
                 cap = cv2.VideoCapture(video_path)
+                cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # frames are queued in dump_video already
                 length_video = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-                fr_count = 0
-                # print("Debug 1")
-                while cap.isOpened():
-                    ret, frame = cap.read()
-                    fr_count += 1
-                    # print("Debug 3")
-                    if fr_count % 1000 == 0:
-                        print("Processing frame = ", fr_count, "/", length_video)
-                        # break
-                    if fr_count % 6 == 0:
-                        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                        if fr_count >= (length_video-10):
-                            print("Video: ", video_path, " is over")
-                            break
-
-                        data = (EyeFrame.Detection() & video & dict(frame=fr_count)).fetch.as_dict()
-                        if data:
-                            data = data[0]
-                            ellipse = ((int(data['pupil_x']),int(data['pupil_y'])),(int(data['pupil_r_minor']),int(data['pupil_r_major'])),
-                                       int(data['pupil_angle']))
-                            _ = cv2.ellipse(gray, ellipse, (0, 0, 255), 2)
-                        name = "temp_images/img%06d.png" % (fr_count,)
-                        cv2.imwrite(name, gray)
-                print("Dumped images for parameters (mouse_id,scan_idx) = (", video['mouse_id'], video['scan_idx'], ")")
-                print("Stitching images into a video")
+                width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                # ellipse parameters for all detected frames, converted to int in one go
+                detected, *ellipse_params = (EyeFrame.Detection() & video).fetch['frame', 'pupil_x', 'pupil_y',
+                                                                                 'pupil_r_minor', 'pupil_r_major',
+                                                                                 'pupil_angle']
+                ellipses = {fr: ((x, y), (r_minor, r_major), angle) for fr, (x, y, r_minor, r_major, angle)
+                            in zip(detected.tolist(), np.stack(ellipse_params, axis=1).astype(int).tolist())}
+
+                # frames are piped to ffmpeg as raw grayscale instead of going through png files
                 file_name = "video_%s_%s.mp4" % (video['mouse_id'], video['scan_idx'])
+                command = ["ffmpeg", "-y", "-f", "rawvideo", "-pix_fmt", "gray",
+                           "-s", "{w}x{h}".format(w=width, h=height), "-r", "5", "-i", "-",
+                           "-c:v", codec, "-preset", preset, "-threads", "0", "-pix_fmt", "yuv420p",
+                           file_name]
+                proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+                # decoding runs in its own thread (cv2 releases the GIL) while this one draws and encodes
+                frames = queue.Queue(maxsize=64)
+                stop = threading.Event()  # tells the reader to quit if encoding fails
+                reader = threading.Thread(target=_read_sampled_frames,
+                                          args=(cap, length_video, frames, 6, stop), daemon=True)
+                reader.start()
+                gray_buf = np.empty((height, width), dtype=np.uint8)  # reused for every frame
                 try:
-                    os.remove(file_name)
-                except:
-                    pass
-                command = "ffmpeg -f image2 -pattern_type glob -i 'temp_images/*.png' "+file_name
-                # command = "ffmpeg -framerate 5 -i temp_images\%06d.png -c:v libx264 -r 5 -pix_fmt yuv420p "+file_name
-                os.system(command)
-
-                # embed()
-                try:
-                    shutil.rmtree("temp_images")
-                except:
-                    pass
+                    for item in iter(frames.get, None):
+                        if isinstance(item, Exception):  # reader failed
+                            raise item
+                        fr_count, frame = item
+                        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray_buf)
+                        if fr_count in ellipses:
+                            cv2.ellipse(gray, ellipses[fr_count], (0, 0, 255), 2)
+                        proc.stdin.write(gray.data)  # contiguous, written without a copy
+                except BaseException:  # e.g. BrokenPipeError if ffmpeg died (unavailable codec)
+                    proc.kill()
+                    proc.wait()
+                    raise
+                finally:
+                    stop.set()
+                    reader.join()
+                    cap.release()
+                print("Video: ", video_path, " is over")
+                print("Dumped frames for parameters (mouse_id,scan_idx) = (", video['mouse_id'], video['scan_idx'], ")")
+                print("Finishing video encoding")
+                proc.stdin.close()  # ffmpeg finishes this video while the next one is dumped
+                encoders.append(proc)
+                if len(encoders) > 1:  # at most one encoder lagging behind
+                    encoders.pop(0).wait()
+        for proc in encoders:
+            proc.wait()
 
 
 
@@ -182,6 +275,12 @@ class ParamEyeFrame(dj.Lookup):
     ]
 
 
+@functools.lru_cache(maxsize=None)
+def _fetch_tracker_param(pupil_tracker_param_id):
+    """ ParamEyeFrame lookup, cached because the contents of the lookup table are fixed."""
+    return (ParamEyeFrame() & dict(pupil_tracker_param_id=pupil_tracker_param_id)).fetch.as_dict()[0]
+
+
 @schema
 class EyeFrame(dj.Computed):
     definition = """
@@ -199,10 +298,11 @@ class EyeFrame(dj.Computed):
 
     def _make_tuples(self, key):
         # embed()
-        param = (ParamEyeFrame() & 'pupil_tracker_param_id=0').fetch.as_dict()[0]
+        param = dict(_fetch_tracker_param(0))  # copy, it is modified below
         key['pupil_tracker_param_id'] = param['pupil_tracker_param_id']
-        video_path = (TrackInfo() & key).fetch1['base_video_path']
-        eye_roi = (Roi() & key).fetch1['x_roi_min', 'y_roi_min', 'x_roi_max', 'y_roi_max']
+        video_path, *eye_roi = (TrackInfo() * Roi() & key).fetch1['base_video_path', 'x_roi_min', 'y_roi_min',
+                                                                  'x_roi_max', 'y_roi_max']
+        eye_roi = tuple(eye_roi)
         param['centre_dislocation_penalty'] = 0.001
         param['distance_sq_pow'] = 1
 
@@ -211,16 +311,13 @@ class EyeFrame(dj.Computed):
 
         # CODE to insert data after tracking
         print("Tracking complete... Now inserting data to datajoint")
-        efd = EyeFrame.Detection()
         # embed()
-        for index, data in trace.iterrows():
-            key['frame'] = index
-            self.insert1(key)
-            if pd.notnull(data['pupil_x']):
-                values = data.to_dict()
-                values.update(key)
-                # embed()
-                efd.insert1(values)
+        self.insert([dict(key, frame=int(index)) for index in trace.index])
+        detected = trace['pupil_x'].notnull().values
+        columns = list(trace.columns)
+        EyeFrame.Detection().insert([dict(zip(columns, values), frame=int(index), **key)
+                                     for index, values in zip(trace.index.values[detected],
+                                                              trace.values[detected])])
 
     class Detection(dj.Part):
         definition = """
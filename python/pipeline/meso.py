@@ -1,6 +1,7 @@
 """ Schemas for mesoscope scans."""
 import datajoint as dj
 from datajoint.jobs import key_hash
+import functools
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -114,7 +115,7 @@ class ScanInfo(dj.Imported):
         # Read the scan
         print("Reading header...")
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = performance.read_scan(scan_filename)
 
         # Get attributes
         tuple_ = key.copy()  # in case key is reused somewhere else
@@ -231,7 +232,7 @@ class Quality(dj.Computed):
     def make(self, key):
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = performance.read_scan(scan_filename)
 
         # Insert in Quality
         self.insert1(key)
@@ -263,18 +264,22 @@ class Quality(dj.Computed):
 
                 # Compute quantal size
                 middle_frame = int(np.floor(scan.num_frames / 2))
-                mini_scan = scan[
-                    field_id,
-                    :,
-                    :,
-                    channel,
-                    max(middle_frame - 2000, 0) : middle_frame + 2000,
-                ]
-                mini_scan = mini_scan.astype(np.float32)
-                results = quality.compute_quantal_size(mini_scan)
-                min_intensity, max_intensity, _, _, quantal_size, zero_level = results
+                frame_start = max(middle_frame - 2000, 0)
+                frame_stop = min(middle_frame + 2000, scan.num_frames)
+                results = quality.compute_quantal_size_streaming(
+                    scan, field_id, channel, frame_start, frame_stop
+                )
+                (
+                    min_intensity,
+                    max_intensity,
+                    _,
+                    _,
+                    quantal_size,
+                    zero_level,
+                    pixel_sum,
+                ) = results
                 quantal_frame = (
-                    np.mean(mini_scan, axis=-1) - zero_level
+                    pixel_sum / (frame_stop - frame_start) - zero_level
                 ) / quantal_size
 
                 # Compute abnormal event frequency
@@ -395,7 +400,7 @@ class RasterCorrection(dj.Computed):
 
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename, dtype=np.float32)
+        scan = performance.read_scan(scan_filename, np.float32)
 
         # Select correction channel
         channel = (CorrectionChannel() & key).fetch1("channel") - 1
@@ -471,7 +476,7 @@ class MotionCorrection(dj.Computed):
 
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = performance.read_scan(scan_filename)
 
         # Get some params
         px_height, px_width = (ScanInfo.Field() & key).fetch1("px_height", "px_width")
@@ -616,7 +621,7 @@ class MotionCorrection(dj.Computed):
 
         # Load the scan
         scan_filename = (experiment.Scan() & self).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename, dtype=np.float32)
+        scan = performance.read_scan(scan_filename, np.float32)
         scan_ = scan[
             self.fetch1("field") - 1, :, :, channel - 1, start_index:stop_index
         ]
@@ -655,9 +660,10 @@ class MotionCorrection(dj.Computed):
         def update_img(i):
             im1.set_data(original_scan[:, :, i])
             im2.set_data(corrected_scan[:, :, i])
+            return im1, im2
 
         video = animation.FuncAnimation(
-            fig, update_img, corrected_scan.shape[2], interval=1000 / fps
+            fig, update_img, corrected_scan.shape[2], interval=1000 / fps, blit=True
         )
 
         # Save animation
@@ -721,7 +727,7 @@ class SummaryImages(dj.Computed):
     def make(self, key):
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = performance.read_scan(scan_filename)
 
         for channel in range(scan.num_channels):
             # Map: Compute some statistics in different chunks of the scan
@@ -985,7 +991,7 @@ class Segmentation(dj.Computed):
             # Read scan
             print("Reading scan...")
             scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-            scan = scanreader.read_scan(scan_filename)
+            scan = performance.read_scan(scan_filename)
 
             # Create memory mapped file (as expected by CaImAn)
             print("Creating memory mapped file...")
@@ -1175,7 +1181,7 @@ class Segmentation(dj.Computed):
             channel = self.fetch1("channel") - 1
             field_id = self.fetch1("field") - 1
             scan_filename = (experiment.Scan() & self).local_filenames_as_wildcard
-            scan = scanreader.read_scan(scan_filename, dtype=np.float32)
+            scan = performance.read_scan(scan_filename, np.float32)
             scan_ = scan[field_id, :, :, channel, start_index:stop_index]
 
             # Correct the scan
@@ -1253,9 +1259,10 @@ class Segmentation(dj.Computed):
                 im2.set_data(extracted[:, :, i])
                 im3.set_data(background[:, :, i])
                 im4.set_data(residual[:, :, i])
+                return im1, im2, im3, im4
 
             video = animation.FuncAnimation(
-                fig, update_img, scan_.shape[2], interval=1000 / fps
+                fig, update_img, scan_.shape[2], interval=1000 / fps, blit=True
             )
 
             # Save animation
@@ -1315,14 +1322,15 @@ class Segmentation(dj.Computed):
         masks = np.zeros(
             [image_height, image_width, len(mask_pixels)], dtype=np.float32
         )
+        if len(mask_pixels) == 0:
+            return masks
 
-        # Reshape each mask
-        for i, (mp, mw) in enumerate(zip(mask_pixels, mask_weights)):
-            mask_as_vector = np.zeros(image_height * image_width)
-            mask_as_vector[np.squeeze(mp - 1).astype(int)] = np.squeeze(mw)
-            masks[:, :, i] = mask_as_vector.reshape(
-                image_height, image_width, order="F"
-            )
+        # Scatter all masks at once (pixels are 1-based indices of F-ordered images)
+        pixels = [np.ravel(mp).astype(int) - 1 for mp in mask_pixels]
+        mask_ids = np.repeat(np.arange(len(pixels)), [len(mp) for mp in pixels])
+        pixels = np.concatenate(pixels)
+        weights = np.concatenate([np.ravel(mw) for mw in mask_weights])
+        masks[pixels % image_height, pixels // image_height, mask_ids] = weights
 
         return masks
 
@@ -1417,7 +1425,7 @@ class Fluorescence(dj.Computed):
         field_id = key["field"] - 1
         channel = key["channel"] - 1
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = performance.read_scan(scan_filename)
 
         # Map: Extract traces
         print("Creating fluorescence traces...")
@@ -1471,7 +1479,7 @@ class Fluorescence(dj.Computed):
     def get_all_traces(self):
         """ Returns a num_traces x num_timesteps matrix with all traces."""
         traces = (Fluorescence.Trace() & self).fetch("trace", order_by="mask_id")
-        return np.array([x.squeeze() for x in traces])
+        return signal.stack_traces(traces)
 
 
 @schema
@@ -1516,7 +1524,6 @@ class MaskClassification(dj.Computed):
         mask_ids, pixels, weights = (Segmentation.Mask() & key).fetch(
             "mask_id", "pixels", "weights"
         )
-        masks = Segmentation.reshape_masks(pixels, weights, image_height, image_width)
 
         # Classify masks
         if key["classification_method"] == 1:  # manual
@@ -1525,11 +1532,17 @@ class MaskClassification(dj.Computed):
                 raise PipelineException(msg)
 
             template = (SummaryImages.Correlation() & key).fetch1("correlation_image")
-            masks = masks.transpose([2, 0, 1])  # num_masks, image_height, image_width
+            masks = (  # one mask at a time, shown as needed
+                Segmentation.reshape_masks([p], [w], image_height, image_width)[..., 0]
+                for p, w in zip(pixels, weights)
+            )
             mask_types = mask_classification.classify_manual(masks, template)
         elif key["classification_method"] == 2:  # cnn-caiman
             from .utils import caiman_interface as cmn
 
+            masks = Segmentation.reshape_masks(
+                pixels, weights, image_height, image_width
+            )
             soma_diameter = tuple(14 / (ScanInfo.Field() & key).microns_per_pixel)
             probs = cmn.classify_masks(masks, soma_diameter)
             mask_types = ["soma" if prob > 0.75 else "artifact" for prob in probs]
@@ -1691,31 +1704,35 @@ class ScanSet(dj.Computed):
 
         # Get next unit_id for scan
         unit_rel = ScanSet.Unit().proj() & key
-        unit_id = np.max(unit_rel.fetch("unit_id")) + 1 if unit_rel else 1
+        max_unit_id = dj.U().aggr(unit_rel, max_id="MAX(unit_id)").fetch1("max_id")
+        unit_id = 1 if max_unit_id is None else max_unit_id + 1
 
         # Insert in ScanSet
         self.insert1(key)
 
         # Insert units
-        unit_ids = range(unit_id, unit_id + len(mask_ids) + 1)
+        unit_ids = np.arange(unit_id, unit_id + len(mask_ids))
+        units, unit_infos = [], []
         for unit_id, mask_id, (um_y, um_x), (px_y, px_x), delay in zip(
             unit_ids, mask_ids, um_centroids, px_centroids, delays
         ):
-            ScanSet.Unit().insert1({**key, "unit_id": unit_id, "mask_id": mask_id})
-
-            unit_info = {
-                **key,
-                "unit_id": unit_id,
-                "um_x": um_x,
-                "um_y": um_y,
-                "um_z": um_z,
-                "px_x": px_x,
-                "px_y": px_y,
-                "ms_delay": delay,
-            }
-            ScanSet.UnitInfo().insert1(
-                unit_info, ignore_extra_fields=True
-            )  # ignore field and channel
+            units.append({**key, "unit_id": unit_id, "mask_id": mask_id})
+            unit_infos.append(
+                {
+                    **key,
+                    "unit_id": unit_id,
+                    "um_x": um_x,
+                    "um_y": um_y,
+                    "um_z": um_z,
+                    "px_x": px_x,
+                    "px_y": px_y,
+                    "ms_delay": delay,
+                }
+            )
+        ScanSet.Unit().insert(units)
+        ScanSet.UnitInfo().insert(
+            unit_infos, ignore_extra_fields=True
+        )  # ignore field and channel
 
     def plot_centroids(self, first_n=None):
         """Draw masks centroids over the correlation image. Works on a single field/channel
@@ -1835,34 +1852,40 @@ class Activity(dj.Computed):
         self.insert1(key)
         if key["spike_method"] == 2:  # oopsie
             import pyfnnd  # Install from https://github.com/cajal/PyFNND.git
+            import multiprocessing as mp
 
-            for unit_id, trace in zip(unit_ids, full_traces):
-                spike_trace = pyfnnd.deconvolve(trace, dt=1 / fps)[0].astype(
-                    np.float32, copy=False
-                )
-                Activity.Trace().insert1(
-                    {**key, "unit_id": unit_id, "trace": spike_trace}
+            with mp.Pool(10) as pool:
+                results = pool.map(
+                    functools.partial(pyfnnd.deconvolve, dt=1 / fps), full_traces
                 )
 
+            trace_rows = []
+            for unit_id, result in zip(unit_ids, results):
+                spike_trace = result[0].astype(np.float32, copy=False)
+                trace_rows.append({**key, "unit_id": unit_id, "trace": spike_trace})
+            Activity.Trace().insert(trace_rows)
+
         elif key["spike_method"] == 3:  # stm
             import c2s  # Install from https://github.com/lucastheis/c2s
 
-            for unit_id, trace in zip(unit_ids, full_traces):
+            trace_dicts = []
+            for trace in full_traces:
                 start = signal.notnan(trace)
                 end = signal.notnan(trace, len(trace) - 1, increment=-1)
-                trace_dict = {
-                    "calcium": np.atleast_2d(trace[start : end + 1]),
-                    "fps": fps,
-                }
-
-                data = c2s.predict(c2s.preprocess([trace_dict], fps=fps), verbosity=0)
-                spike_trace = np.squeeze(data[0].pop("predictions")).astype(
-                    np.float32, copy=False
+                trace_dicts.append(
+                    {"calcium": np.atleast_2d(trace[start : end + 1]), "fps": fps}
                 )
 
-                Activity.Trace().insert1(
-                    {**key, "unit_id": unit_id, "trace": spike_trace}
+            # Preprocess and predict all traces in one call
+            data = c2s.predict(c2s.preprocess(trace_dicts, fps=fps), verbosity=0)
+
+            trace_rows = []
+            for unit_id, unit_data in zip(unit_ids, data):
+                spike_trace = np.squeeze(unit_data.pop("predictions")).astype(
+                    np.float32, copy=False
                 )
+                trace_rows.append({**key, "unit_id": unit_id, "trace": spike_trace})
+            Activity.Trace().insert(trace_rows)
 
         elif key["spike_method"] == 5:  # nmf
             from pipeline.utils import caiman_interface as cmn
@@ -1870,15 +1893,14 @@ class Activity(dj.Computed):
 
             with mp.Pool(10) as pool:
                 results = pool.map(cmn.deconvolve, full_traces)
+
+            trace_rows, ar_rows = [], []
             for unit_id, (spike_trace, ar_coeffs) in zip(unit_ids, results):
                 spike_trace = spike_trace.astype(np.float32, copy=False)
-                Activity.Trace().insert1(
-                    {**key, "unit_id": unit_id, "trace": spike_trace}
-                )
-                Activity.ARCoefficients().insert1(
-                    {**key, "unit_id": unit_id, "g": ar_coeffs},
-                    ignore_extra_fields=True,
-                )
+                trace_rows.append({**key, "unit_id": unit_id, "trace": spike_trace})
+                ar_rows.append({**key, "unit_id": unit_id, "g": ar_coeffs})
+            Activity.Trace().insert(trace_rows)
+            Activity.ARCoefficients().insert(ar_rows, ignore_extra_fields=True)
         else:
             msg = "Unrecognized spike method {}".format(key["spike_method"])
             raise PipelineException(msg)
@@ -1907,6 +1929,8 @@ class Activity(dj.Computed):
         :returns Figure. You can call show() on it.
         :rtype: matplotlib.figure.Figure
         """
+        from scipy.signal import lfilter
+
         ar_rel = Activity.ARCoefficients() & (Activity.Trace() & self)
         if ar_rel:  # if an AR model was used
             # Get some params
@@ -1918,17 +1942,11 @@ class Activity(dj.Computed):
             x_axis = np.arange(num_timepoints) / fps  # make it seconds
 
             # Over each trace
+            impulse = np.zeros(num_timepoints)
+            impulse[0] = 1  # initial spike
             for g in ar_coeffs:
-                AR_order = len(g)
-
-                # Calculate impulse response function
-                irf = np.zeros(num_timepoints)
-                irf[0] = 1  # initial spike
-                for i in range(1, num_timepoints):
-                    if i <= AR_order:  # start of the array needs special care
-                        irf[i] = np.sum(g[:i] * irf[i - 1 :: -1])
-                    else:
-                        irf[i] = np.sum(g * irf[i - 1 : i - AR_order - 1 : -1])
+                # Calculate impulse response function (all-pole filter given by the AR model)
+                irf = lfilter([1], np.concatenate([[1], -np.ravel(g)]), impulse)
 
                 # Plot
                 plt.plot(x_axis, irf)
@@ -1939,7 +1957,7 @@ class Activity(dj.Computed):
     def get_all_spikes(self):
         """ Returns a num_traces x num_timesteps matrix with all spikes."""
         spikes = (Activity.Trace() & self).fetch("trace", order_by="unit_id")
-        return np.array([x.squeeze() for x in spikes])
+        return signal.stack_traces(spikes)
 
 
 @schema
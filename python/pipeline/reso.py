@@ -1,6 +1,7 @@
 """ Schemas for resonant scanners."""
 import datajoint as dj
 from datajoint.jobs import key_hash
+import functools
 import matplotlib.pyplot as plt
 import numpy as np
 import scanreader
@@ -72,7 +73,7 @@ class ScanInfo(dj.Imported):
         # Read the scan
         print('Reading header...')
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = performance.read_scan(scan_filename)
 
         # Get attributes
         tuple_ = key.copy()  # in case key is reused somewhere else
@@ -94,10 +95,15 @@ class ScanInfo(dj.Imported):
         # Estimate height and width in microns using measured FOVs for similar setups
         fov_rel = (experiment.FOV() * experiment.Session() * experiment.Scan() & key
                    & 'session_date>=fov_ts')
-        zooms = fov_rel.fetch('mag').astype(np.float32)  # zooms measured in same setup
+        zooms, heights, widths = fov_rel.fetch('mag', 'height', 'width')  # same setup
+        zooms = zooms.astype(np.float32)
         closest_zoom = zooms[np.argmin(np.abs(np.log(zooms / scan.zoom)))]
 
-        dims = (fov_rel & 'ABS(mag - {}) < 1e-4'.format(closest_zoom)).fetch1('height', 'width')
+        matches = np.flatnonzero(np.abs(zooms - closest_zoom) < 1e-4)
+        if len(matches) != 1:
+            raise PipelineException('Expected one FOV measurement for zoom {}, found '
+                                    '{}'.format(closest_zoom, len(matches)))
+        dims = heights[matches[0]], widths[matches[0]]
         um_height, um_width = [float(um) * (closest_zoom / scan.zoom) for um in dims]
         tuple_['um_height'] = um_height * scan._y_angle_scale_factor
         tuple_['um_width'] = um_width * scan._x_angle_scale_factor
@@ -117,9 +123,9 @@ class ScanInfo(dj.Imported):
         field_depths = motor_zero + rel_field_depths
 
         # Insert field information
-        for field_id, (field_z, field_offsets) in enumerate(zip(field_depths, scan.field_offsets)):
-            ScanInfo.Field().insert1({**key, 'field': field_id + 1, 'z': field_z,
-                                      'delay_image': field_offsets})
+        ScanInfo.Field().insert([{**key, 'field': field_id + 1, 'z': field_z,
+                                  'delay_image': field_offsets} for field_id, (field_z, field_offsets)
+                                 in enumerate(zip(field_depths, scan.field_offsets))])
 
         # Fill in CorrectionChannel if only one channel
         if scan.num_channels == 1:
@@ -221,11 +227,22 @@ class Quality(dj.Computed):
     def make(self, key):
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = performance.read_scan(scan_filename)
 
         # Insert in Quality
         self.insert1(key)
 
+        # Compute quantal size for all fields and channels (reads the frames only once)
+        middle_frame = int(np.floor(scan.num_frames / 2))
+        frame_start = max(middle_frame - 2000, 0)
+        frame_stop = min(middle_frame + 2000, scan.num_frames)
+        quantal_results = quality.compute_quantal_sizes_streaming(scan, frame_start,
+                                                                  frame_stop)
+
+        # Rows for the part tables (inserted together after all fields are processed)
+        mean_intensity_rows, contrast_rows, summary_rows = [], [], []
+        quantal_size_rows, epileptiform_rows = [], []
+        notify_args = []
         for field_id in range(scan.num_fields):
             print('Computing quality metrics for field', field_id + 1)
             for channel in range(scan.num_channels):
@@ -243,13 +260,10 @@ class Quality(dj.Computed):
                 mean_groups = np.array_split([r[3] for r in sorted_results], 16) # 16 groups
                 frames = np.stack([np.mean(g, axis=0) for g in mean_groups if g.any()], axis=-1)
 
-                # Compute quantal size
-                middle_frame = int(np.floor(scan.num_frames / 2))
-                mini_scan = scan[field_id, :, :, channel, max(middle_frame - 2000, 0): middle_frame + 2000]
-                mini_scan = mini_scan.astype(np.float32)
-                results = quality.compute_quantal_size(mini_scan)
-                min_intensity, max_intensity, _, _, quantal_size, zero_level = results
-                quantal_frame = (np.mean(mini_scan, axis=-1) - zero_level) / quantal_size
+                # Get quantal size
+                results = quantal_results[field_id][channel]
+                min_intensity, max_intensity, _, _, quantal_size, zero_level, pixel_sum = results
+                quantal_frame = (pixel_sum / (frame_stop - frame_start) - zero_level) / quantal_size
 
                 # Compute abnormal event frequency
                 deviations = (mean_intensities - mean_intensities.mean()) / mean_intensities.mean()
@@ -258,23 +272,32 @@ class Quality(dj.Computed):
                 abnormal = peaks[[p > 0.2 and w < 0.4 for p, w in zip(prominences, widths)]]
                 abnormal_freq = len(abnormal) / (scan.num_frames / scan.fps)
 
-                # Insert
+                # Collect rows
                 field_key = {**key, 'field': field_id + 1, 'channel': channel + 1}
-                self.MeanIntensity().insert1({**field_key, 'intensities': mean_intensities})
-                self.Contrast().insert1({**field_key, 'contrasts': contrasts})
-                self.SummaryFrames().insert1({**field_key, 'summary': frames})
-                self.QuantalSize().insert1({**field_key, 'min_intensity': min_intensity,
-                                            'max_intensity': max_intensity,
-                                            'quantal_size': quantal_size,
-                                            'zero_level': zero_level,
-                                            'quantal_frame': quantal_frame})
-                self.EpileptiformEvents.insert1({**field_key, 'frequency': abnormal_freq,
-                                                 'abn_indices': abnormal,
-                                                 'peak_indices': peaks,
-                                                 'prominences': prominences,
-                                                 'widths': widths})
-
-                self.notify(field_key, frames, mean_intensities, contrasts)
+                mean_intensity_rows.append({**field_key, 'intensities': mean_intensities})
+                contrast_rows.append({**field_key, 'contrasts': contrasts})
+                summary_rows.append({**field_key, 'summary': frames})
+                quantal_size_rows.append({**field_key, 'min_intensity': min_intensity,
+                                          'max_intensity': max_intensity,
+                                          'quantal_size': quantal_size,
+                                          'zero_level': zero_level,
+                                          'quantal_frame': quantal_frame})
+                epileptiform_rows.append({**field_key, 'frequency': abnormal_freq,
+                                          'abn_indices': abnormal,
+                                          'peak_indices': peaks,
+                                          'prominences': prominences,
+                                          'widths': widths})
+                notify_args.append((field_key, frames, mean_intensities, contrasts))
+
+        # Insert
+        self.MeanIntensity().insert(mean_intensity_rows)
+        self.Contrast().insert(contrast_rows)
+        self.SummaryFrames().insert(summary_rows)
+        self.QuantalSize().insert(quantal_size_rows)
+        self.EpileptiformEvents().insert(epileptiform_rows)
+
+        for args in notify_args:
+            self.notify(*args)
 
     @notify.ignore_exceptions
     def notify(self, key, summary_frames, mean_intensities, contrasts):
@@ -345,7 +368,7 @@ class RasterCorrection(dj.Computed):
 
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename, dtype=np.float32)
+        scan = performance.read_scan(scan_filename)
 
         # Select correction channel
         channel = (CorrectionChannel() & key).fetch1('channel') - 1
@@ -354,7 +377,7 @@ class RasterCorrection(dj.Computed):
         # Load some frames from the middle of the scan
         middle_frame =  int(np.floor(scan.num_frames / 2))
         frames = slice(max(middle_frame - 1000, 0), middle_frame + 1000)
-        mini_scan = scan[field_id, :, :, channel, frames]
+        mini_scan = scan[field_id, :, :, channel, frames].astype(np.float32)
 
         # Create results tuple
         tuple_ = key.copy()
@@ -362,8 +385,9 @@ class RasterCorrection(dj.Computed):
         # Create template (average frame tapered to avoid edge artifacts)
         taper = np.sqrt(np.outer(tukey(scan.image_height, 0.4),
                                  tukey(scan.image_width, 0.4)))
-        anscombed = 2 * np.sqrt(mini_scan - mini_scan.min() + 3 / 8)  # anscombe transform
-        template = np.mean(anscombed, axis=-1) * taper
+        mini_scan -= mini_scan.min() - 3 / 8  # anscombe transform (in place)
+        np.sqrt(mini_scan, out=mini_scan)
+        template = 2 * np.mean(mini_scan, axis=-1) * taper
         tuple_['raster_template'] = template
 
         # Compute raster correction parameters
@@ -378,10 +402,11 @@ class RasterCorrection(dj.Computed):
 
     def get_correct_raster(self):
         """ Returns a function to perform raster correction on the scan. """
-        raster_phase = self.fetch1('raster_phase')
-        fill_fraction = (ScanInfo() & self).fetch1('fill_fraction')
+        raster_phase, fill_fraction = (self * ScanInfo()).fetch1('raster_phase',
+                                                                 'fill_fraction')
         if abs(raster_phase) < 1e-7:
-            correct_raster = lambda scan: scan.astype(np.float32, copy=False)
+            correct_raster = lambda scan: (scan if scan.dtype == np.float32 else
+                                           scan.astype(np.float32))
         else:
             correct_raster = lambda scan: galvo_corrections.correct_raster(scan,
                                                              raster_phase, fill_fraction)
@@ -422,7 +447,7 @@ class MotionCorrection(dj.Computed):
 
             # Read the scan
             scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-            scan = scanreader.read_scan(scan_filename)
+            scan = performance.read_scan(scan_filename)
 
             # Load some frames from middle of scan to compute template
             skip_rows = int(round(px_height * 0.10))  # we discard some rows/cols to avoid edge artifacts
@@ -437,16 +462,19 @@ class MotionCorrection(dj.Computed):
             mini_scan = correct_raster(mini_scan)
 
             # Create template
-            mini_scan = 2 * np.sqrt(mini_scan - mini_scan.min() + 3 / 8)  # *
-            template = np.mean(mini_scan, axis=-1)
-            template = ndimage.gaussian_filter(template, 0.7)  # **
+            mini_scan -= mini_scan.min() - 3 / 8  # * (in place, no temporaries)
+            np.sqrt(mini_scan, out=mini_scan)
+            template = 2 * np.mean(mini_scan, axis=-1)
+            smoothed = np.empty_like(template)
+            ndimage.gaussian_filter1d(template, 0.7, axis=0, output=smoothed)  # **
+            ndimage.gaussian_filter1d(smoothed, 0.7, axis=1, output=template)
             # * Anscombe tranform to normalize noise, increase contrast and decrease outliers' leverage
             # ** Small amount of gaussian smoothing to get rid of high frequency noise
 
             # Map: compute motion shifts in parallel
             f = performance.parallel_motion_shifts  # function to map
-            raster_phase = (RasterCorrection() & key).fetch1('raster_phase')
-            fill_fraction = (ScanInfo() & key).fetch1('fill_fraction')
+            raster_phase, fill_fraction = (RasterCorrection() * ScanInfo() & key).fetch1(
+                'raster_phase', 'fill_fraction')
             kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
                       'template': template}
             results = performance.map_frames(f, scan, field_id=field_id,
@@ -539,15 +567,15 @@ class MotionCorrection(dj.Computed):
         :rtype: matplotlib.figure.Figure
         """
         # Get fps and total_num_frames
-        fps = (ScanInfo() & self).fetch1('fps')
+        fps, field = (self * ScanInfo()).fetch1('fps', 'field')
         num_video_frames = int(round(fps * seconds))
         stop_index = start_index + num_video_frames
 
         # Load the scan
         scan_filename = (experiment.Scan() & self).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename, dtype=np.float32)
-        scan_ = scan[self.fetch1('field') - 1, :, :, channel - 1, start_index: stop_index]
-        original_scan = scan_.copy()
+        scan = performance.read_scan(scan_filename)
+        original_scan = scan[field - 1, :, :, channel - 1, start_index: stop_index]
+        scan_ = original_scan.astype(np.float32)
 
         # Correct the scan
         correct_raster = (RasterCorrection() & self).get_correct_raster()
@@ -576,9 +604,10 @@ class MotionCorrection(dj.Computed):
         def update_img(i):
             im1.set_data(original_scan[:, :, i])
             im2.set_data(corrected_scan[:, :, i])
+            return im1, im2
 
         video = animation.FuncAnimation(fig, update_img, corrected_scan.shape[2],
-                                        interval=1000 / fps)
+                                        interval=1000 / fps, blit=True)
 
         # Save animation
         if not filename.endswith('.mp4'):
@@ -636,27 +665,38 @@ class SummaryImages(dj.Computed):
     def make(self, key):
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = performance.read_scan(scan_filename)
+
+        # Get correction params (same for all channels)
+        raster_phase, fill_fraction = (RasterCorrection() * ScanInfo() & key).fetch1(
+            'raster_phase', 'fill_fraction')
+        y_shifts, x_shifts = (MotionCorrection() & key).fetch1('y_shifts', 'x_shifts')
+        kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
+                  'y_shifts': y_shifts, 'x_shifts': x_shifts}
 
+        totals = None # sums over all chunks (reused across channels)
         for channel in range(scan.num_channels):
             # Map: Compute some statistics in different chunks of the scan
             f = performance.parallel_summary_images # function to map
-            raster_phase = (RasterCorrection() & key).fetch1('raster_phase')
-            fill_fraction = (ScanInfo() & key).fetch1('fill_fraction')
-            y_shifts, x_shifts = (MotionCorrection() & key).fetch1('y_shifts', 'x_shifts')
-            kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
-                      'y_shifts': y_shifts, 'x_shifts': x_shifts}
             results = performance.map_frames(f, scan, field_id=key['field'] - 1,
                                              channel=channel, kwargs=kwargs)
 
+            # Reduce: Add up statistics from all chunks (in place)
+            if totals is None:
+                totals = [np.zeros(np.shape(stat)) for stat in results[0]]
+            else:
+                for total in totals:
+                    total.fill(0)
+            for chunk_stats in results:
+                for total, stat in zip(totals, chunk_stats):
+                    total += stat
+            sum_, sum_sixth, sum_x, sum_sqx, sum_xy = totals # sum_xy is h x w x 8
+
             # Reduce: Compute average images
-            average_image = np.sum([r[0] for r in results], axis=0) / scan.num_frames
-            l6norm_image = np.sum([r[1] for r in results], axis=0) ** (1 / 6)
+            average_image = sum_ / scan.num_frames
+            l6norm_image = sum_sixth ** (1 / 6)
 
             # Reduce: Compute correlation image
-            sum_x = np.sum([r[2] for r in results], axis=0) # h x w
-            sum_sqx = np.sum([r[3] for r in results], axis=0) # h x w
-            sum_xy = np.sum([r[4] for r in results], axis=0) # h x w x 8
             denom_factor = np.sqrt(scan.num_frames * sum_sqx - sum_x ** 2)
             corrs = np.zeros(sum_xy.shape)
             for k in [0, 1, 2, 3]:
@@ -841,6 +881,7 @@ class Segmentation(dj.Computed):
             See caiman_interface.extract_masks for explanation of parameters
             """
             from .utils import caiman_interface as cmn
+            from scipy import sparse
             import json
             import uuid
             import os
@@ -858,7 +899,7 @@ class Segmentation(dj.Computed):
             # Read scan
             print('Reading scan...')
             scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-            scan = scanreader.read_scan(scan_filename)
+            scan = performance.read_scan(scan_filename)
 
             # Create memory mapped file (as expected by CaImAn)
             print('Creating memory mapped file...')
@@ -869,8 +910,8 @@ class Segmentation(dj.Computed):
 
             # Map: Correct scan and save in memmap scan
             f = performance.parallel_save_memmap # function to map
-            raster_phase = (RasterCorrection() & key).fetch1('raster_phase')
-            fill_fraction = (ScanInfo() & key).fetch1('fill_fraction')
+            raster_phase, fill_fraction = (RasterCorrection() * ScanInfo() & key).fetch1(
+                'raster_phase', 'fill_fraction')
             y_shifts, x_shifts = (MotionCorrection() & key).fetch1('y_shifts', 'x_shifts')
             kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction, 'y_shifts': y_shifts,
                       'x_shifts': x_shifts, 'mmap_scan': mmap_scan}
@@ -953,43 +994,54 @@ class Segmentation(dj.Computed):
 
             ## Insert masks and traces (masks in Matlab format)
             num_masks = masks.shape[-1]
-            masks = masks.reshape(-1, num_masks, order='F').T  # [num_masks x num_pixels] in F order
+            masks = masks.reshape(-1, num_masks, order='F')  # [num_pixels x num_masks] in F order
+            masks = sparse.csc_matrix(masks)  # nonzero pixels of each mask are contiguous
             raw_traces = raw_traces.astype(np.float32, copy=False)
-            for mask_id, mask, trace in zip(range(1, num_masks + 1), masks, raw_traces):
-                mask_pixels = np.where(mask)[0]
-                mask_weights = mask[mask_pixels]
-                mask_pixels += 1  # matlab indices start at 1
-                Segmentation.Mask().insert1({**key, 'mask_id': mask_id, 'pixels': mask_pixels,
-                                             'weights': mask_weights})
-
-                Fluorescence.Trace().insert1({**key, 'mask_id': mask_id, 'trace': trace})
+            mask_rows, trace_rows = [], []
+            for mask_id, trace in zip(range(1, num_masks + 1), raw_traces):
+                nonzero = slice(masks.indptr[mask_id - 1], masks.indptr[mask_id])
+                mask_pixels = masks.indices[nonzero].astype(np.int64) + 1  # matlab indices start at 1
+                mask_weights = masks.data[nonzero]
+                mask_rows.append({**key, 'mask_id': mask_id, 'pixels': mask_pixels,
+                                  'weights': mask_weights})
+                trace_rows.append({**key, 'mask_id': mask_id, 'trace': trace})
+            Segmentation.Mask().insert(mask_rows)
+            Fluorescence.Trace().insert(trace_rows)
 
             Segmentation().notify(key)
 
         def save_video(self, filename='cnmf_results.mp4', start_index=0, seconds=30,
-                       dpi=250, first_n=None):
-            """ Creates an animation video showing the results of CNMF.
+                       dpi=None, first_n=None):
+            """ Creates a video showing the results of CNMF (at the scan resolution).
 
             :param string filename: Output filename (path + filename)
             :param int start_index: Where in the scan to start the video.
-            :param int seconds: How long in seconds should the animation run.
-            :param int dpi: Dots per inch, controls the quality of the video.
+            :param int seconds: How long in seconds should the video run.
+            :param int dpi: Deprecated and ignored (video is written at the scan resolution).
+                Only kept so old calls still work; passing a value raises a warning.
             :param int first_n: Draw only the first n components.
 
-            :returns Figure. You can call show() on it.
+            :returns Figure with the first frame of each movie. You can call show() on it.
             :rtype: matplotlib.figure.Figure
             """
+            from scipy import sparse
+            import warnings
+
+            if dpi is not None:
+                warnings.warn('dpi is ignored: CNMF videos are written at the scan '
+                              'resolution', DeprecationWarning, stacklevel=2)
+
             # Get fps and calculate total number of frames
-            fps = (ScanInfo() & self).fetch1('fps')
+            fps, field, channel = (self * ScanInfo()).fetch1('fps', 'field', 'channel')
             num_video_frames = int(round(fps * seconds))
             stop_index = start_index + num_video_frames
 
             # Load the scan
-            channel = self.fetch1('channel') - 1
-            field_id = self.fetch1('field') - 1
+            channel = channel - 1
+            field_id = field - 1
             scan_filename = (experiment.Scan() & self).local_filenames_as_wildcard
-            scan = scanreader.read_scan(scan_filename, dtype=np.float32)
-            scan_ = scan[field_id, :, :, channel, start_index: stop_index]
+            scan = performance.read_scan(scan_filename)
+            scan_ = scan[field_id, :, :, channel, start_index: stop_index].astype(np.float32)
 
             # Correct the scan
             correct_raster = (RasterCorrection() & self).get_correct_raster()
@@ -999,12 +1051,15 @@ class Segmentation(dj.Computed):
             # Get scan dimensions
             image_height, image_width, _ = scan_.shape
             num_pixels = image_height * image_width
+            scan_ = np.ascontiguousarray(scan_)  # so it can be used as a pixels x frames view
 
             # Get masks and traces
             masks = (Segmentation() & self).get_all_masks()
             traces = (Fluorescence() & self).get_all_traces()  # always there for CNMF
             background_masks, background_traces = (Segmentation.CNMFBackground() &
                                                    self).fetch1('masks', 'activity')
+            background_masks = background_masks.astype(np.float32, copy=False)  # float32 GEMMs
+            background_traces = background_traces.astype(np.float32, copy=False)
 
             # Select first n components
             if first_n is not None:
@@ -1016,20 +1071,21 @@ class Segmentation(dj.Computed):
             background_traces = background_traces[:, start_index: stop_index]
 
             # Create movies
-            extracted = np.dot(masks.reshape(num_pixels, -1), traces)
-            extracted = extracted.reshape(image_height, image_width, -1)
+            scan2d = scan_.reshape(num_pixels, -1)  # view
+            extracted = sparse.csr_matrix(masks.reshape(num_pixels, -1)).dot(traces)  # sparse A
             background = np.dot(background_masks.reshape(num_pixels, -1), background_traces)
+            residual = np.empty_like(extracted)
+            np.subtract(scan2d, extracted, out=residual)
+            residual -= background
+            extracted = extracted.reshape(image_height, image_width, -1)
             background = background.reshape(image_height, image_width, -1)
-            residual = scan_ - extracted - background
+            residual = residual.reshape(image_height, image_width, -1)
 
-            # Create animation
-            import matplotlib.animation as animation
-
-            ## Set the figure
+            # Create figure (first frame of each movie)
             fig, axes = plt.subplots(2, 2, sharex=True, sharey=True)
 
             axes[0, 0].set_title('Original (Y)')
-            im1 = axes[0, 0].imshow(scan_[:, :, 0], vmin=scan_.min(), vmax=scan_.max())  # just a placeholder
+            im1 = axes[0, 0].imshow(scan_[:, :, 0], vmin=scan_.min(), vmax=scan_.max())
             fig.colorbar(im1, ax=axes[0, 0])
 
             axes[0, 1].set_title('Extracted (A*C)')
@@ -1048,22 +1104,22 @@ class Segmentation(dj.Computed):
             for ax in axes.ravel():
                 ax.axis('off')
 
-            ## Make the animation
-            def update_img(i):
-                im1.set_data(scan_[:, :, i])
-                im2.set_data(extracted[:, :, i])
-                im3.set_data(background[:, :, i])
-                im4.set_data(residual[:, :, i])
+            # Create video (same 2 x 2 layout, each movie mapped to uint8 over its own range)
+            import imageio
 
-            video = animation.FuncAnimation(fig, update_img, scan_.shape[2],
-                                            interval=1000 / fps)
+            mosaic = np.concatenate([
+                np.concatenate([signal.float2uint8(scan_), signal.float2uint8(extracted)], axis=1),
+                np.concatenate([signal.float2uint8(background), signal.float2uint8(residual)], axis=1)])
+            mosaic = np.ascontiguousarray(mosaic.transpose([2, 0, 1]))  # each frame contiguous
+            colormap = (im1.get_cmap()(np.arange(256))[:, :3] * 255).astype(np.uint8)  # uint8 -> RGB
 
-            # Save animation
+            # Save video
             if not filename.endswith('.mp4'):
                 filename += '.mp4'
             print('Saving video at:', filename)
-            print('If this takes too long, stop it and call again with dpi <', dpi, '(default)')
-            video.save(filename, dpi=dpi)
+            with imageio.get_writer(filename, fps=fps, macro_block_size=2) as writer:
+                for frame in mosaic:
+                    writer.append_data(colormap[frame])
 
             return fig
 
@@ -1105,12 +1161,15 @@ class Segmentation(dj.Computed):
     def reshape_masks(mask_pixels, mask_weights, image_height, image_width):
         """ Reshape masks into an image_height x image_width x num_masks array."""
         masks = np.zeros([image_height, image_width, len(mask_pixels)], dtype=np.float32)
+        if len(mask_pixels) == 0:
+            return masks
 
-        # Reshape each mask
-        for i, (mp, mw) in enumerate(zip(mask_pixels, mask_weights)):
-            mask_as_vector = np.zeros(image_height * image_width)
-            mask_as_vector[np.squeeze(mp - 1).astype(int)] = np.squeeze(mw)
-            masks[:, :, i] = mask_as_vector.reshape(image_height, image_width, order='F')
+        # Scatter all masks at once (pixels are 1-based indices of F-ordered images)
+        pixels = [np.ravel(mp).astype(int) - 1 for mp in mask_pixels]
+        mask_ids = np.repeat(np.arange(len(pixels)), [len(mp) for mp in pixels])
+        pixels = np.concatenate(pixels)
+        weights = np.concatenate([np.ravel(mw) for mw in mask_weights])
+        masks[pixels % image_height, pixels // image_height, mask_ids] = weights
 
         return masks
 
@@ -1197,13 +1256,13 @@ class Fluorescence(dj.Computed):
         field_id = key['field'] - 1
         channel = key['channel'] - 1
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = performance.read_scan(scan_filename)
 
         # Map: Extract traces
         print('Creating fluorescence traces...')
         f = performance.parallel_fluorescence # function to map
-        raster_phase = (RasterCorrection() & key).fetch1('raster_phase')
-        fill_fraction = (ScanInfo() & key).fetch1('fill_fraction')
+        raster_phase, fill_fraction = (RasterCorrection() * ScanInfo() & key).fetch1(
+            'raster_phase', 'fill_fraction')
         y_shifts, x_shifts = (MotionCorrection() & key).fetch1('y_shifts', 'x_shifts')
         mask_ids, pixels, weights = (Segmentation.Mask() & key).fetch('mask_id', 'pixels', 'weights')
         kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
@@ -1239,7 +1298,7 @@ class Fluorescence(dj.Computed):
     def get_all_traces(self):
         """ Returns a num_traces x num_timesteps matrix with all traces."""
         traces = (Fluorescence.Trace() & self).fetch('trace', order_by='mask_id')
-        return np.array([x.squeeze() for x in traces])
+        return signal.stack_traces(traces)
 
 
 @schema
@@ -1277,7 +1336,6 @@ class MaskClassification(dj.Computed):
         # Get masks
         image_height, image_width = (ScanInfo() & key).fetch1('px_height', 'px_width')
         mask_ids, pixels, weights = (Segmentation.Mask() & key).fetch('mask_id', 'pixels', 'weights')
-        masks = Segmentation.reshape_masks(pixels, weights, image_height, image_width)
 
         # Classify masks
         if key['classification_method'] == 1:  # manual
@@ -1286,10 +1344,12 @@ class MaskClassification(dj.Computed):
                 raise PipelineException(msg)
 
             template = (SummaryImages.Correlation() & key).fetch1('correlation_image')
-            masks = masks.transpose([2, 0, 1])  # num_masks, image_height, image_width
+            masks = (Segmentation.reshape_masks([p], [w], image_height, image_width)[..., 0]
+                     for p, w in zip(pixels, weights))  # one mask at a time, shown as needed
             mask_types = mask_classification.classify_manual(masks, template)
         elif key['classification_method'] == 2:  # cnn-caiman
             from .utils import caiman_interface as cmn
+            masks = Segmentation.reshape_masks(pixels, weights, image_height, image_width)
             soma_diameter = tuple(14 / (ScanInfo() & key).microns_per_pixel)
             probs = cmn.classify_masks(masks, soma_diameter)
             mask_types = ['soma' if prob > 0.75 else 'artifact' for prob in probs]
@@ -1426,20 +1486,22 @@ class ScanSet(dj.Computed):
 
         # Get next unit_id for scan
         unit_rel = (ScanSet.Unit().proj() & key)
-        unit_id = np.max(unit_rel.fetch('unit_id')) + 1 if unit_rel else 1
+        max_unit_id = dj.U().aggr(unit_rel, max_id='MAX(unit_id)').fetch1('max_id')
+        unit_id = 1 if max_unit_id is None else max_unit_id + 1
 
         # Insert in ScanSet
         self.insert1(key)
 
         # Insert units
-        unit_ids = range(unit_id, unit_id + len(mask_ids) + 1)
+        unit_ids = np.arange(unit_id, unit_id + len(mask_ids))
+        units, unit_infos = [], []
         for unit_id, mask_id, (um_y, um_x), (px_y, px_x), delay in zip(unit_ids, mask_ids,
                                                                        um_centroids, px_centroids, delays):
-            ScanSet.Unit().insert1({**key, 'unit_id': unit_id, 'mask_id': mask_id})
-
-            unit_info = {**key, 'unit_id': unit_id, 'um_x': um_x, 'um_y': um_y,
-                         'um_z': um_z, 'px_x': px_x, 'px_y': px_y, 'ms_delay': delay}
-            ScanSet.UnitInfo().insert1(unit_info, ignore_extra_fields=True)
+            units.append({**key, 'unit_id': unit_id, 'mask_id': mask_id})
+            unit_infos.append({**key, 'unit_id': unit_id, 'um_x': um_x, 'um_y': um_y,
+                               'um_z': um_z, 'px_x': px_x, 'px_y': px_y, 'ms_delay': delay})
+        ScanSet.Unit().insert(units)
+        ScanSet.UnitInfo().insert(unit_infos, ignore_extra_fields=True)
 
     def plot_centroids(self, first_n=None):
         """ Draw masks centroids over the correlation image. Works on a single field/channel
@@ -1556,23 +1618,34 @@ class Activity(dj.Computed):
         self.insert1(key)
         if key['spike_method'] == 2:  # oopsie
             import pyfnnd  # Install from https://github.com/cajal/PyFNND.git
+            import multiprocessing as mp
+
+            with mp.Pool(10) as pool:
+                results = pool.map(functools.partial(pyfnnd.deconvolve, dt=1 / fps), full_traces)
 
-            for unit_id, trace in zip(unit_ids, full_traces):
-                spike_trace = pyfnnd.deconvolve(trace, dt=1 / fps)[0].astype(np.float32, copy=False)
-                Activity.Trace().insert1({**key, 'unit_id': unit_id, 'trace': spike_trace})
+            trace_rows = []
+            for unit_id, result in zip(unit_ids, results):
+                spike_trace = result[0].astype(np.float32, copy=False)
+                trace_rows.append({**key, 'unit_id': unit_id, 'trace': spike_trace})
+            Activity.Trace().insert(trace_rows)
 
         elif key['spike_method'] == 3:  # stm
             import c2s  # Install from https://github.com/lucastheis/c2s
 
-            for unit_id, trace in zip(unit_ids, full_traces):
+            trace_dicts = []
+            for trace in full_traces:
                 start = signal.notnan(trace)
                 end = signal.notnan(trace, len(trace) - 1, increment=-1)
-                trace_dict = {'calcium': np.atleast_2d(trace[start:end + 1]), 'fps': fps}
+                trace_dicts.append({'calcium': np.atleast_2d(trace[start:end + 1]), 'fps': fps})
 
-                data = c2s.predict(c2s.preprocess([trace_dict], fps=fps), verbosity=0)
-                spike_trace = np.squeeze(data[0].pop('predictions')).astype(np.float32, copy=False)
+            # Preprocess and predict all traces in one call
+            data = c2s.predict(c2s.preprocess(trace_dicts, fps=fps), verbosity=0)
 
-                Activity.Trace().insert1({**key, 'unit_id': unit_id, 'trace': spike_trace})
+            trace_rows = []
+            for unit_id, unit_data in zip(unit_ids, data):
+                spike_trace = np.squeeze(unit_data.pop('predictions')).astype(np.float32, copy=False)
+                trace_rows.append({**key, 'unit_id': unit_id, 'trace': spike_trace})
+            Activity.Trace().insert(trace_rows)
 
         elif key['spike_method'] == 5:  # nmf
             from pipeline.utils import caiman_interface as cmn
@@ -1581,11 +1654,13 @@ class Activity(dj.Computed):
             with mp.Pool(10) as pool:
                 results = pool.map(cmn.deconvolve, full_traces)
 
+            trace_rows, ar_rows = [], []
             for unit_id, (spike_trace, ar_coeffs) in zip(unit_ids, results):
                 spike_trace = spike_trace.astype(np.float32, copy=False)
-                Activity.Trace().insert1({**key, 'unit_id': unit_id, 'trace': spike_trace})
-                Activity.ARCoefficients().insert1({**key, 'unit_id': unit_id, 'g': ar_coeffs},
-                                                  ignore_extra_fields=True)
+                trace_rows.append({**key, 'unit_id': unit_id, 'trace': spike_trace})
+                ar_rows.append({**key, 'unit_id': unit_id, 'g': ar_coeffs})
+            Activity.Trace().insert(trace_rows)
+            Activity.ARCoefficients().insert(ar_rows, ignore_extra_fields=True)
         else:
             msg = 'Unrecognized spike method {}'.format(key['spike_method'])
             raise PipelineException(msg)
@@ -1612,6 +1687,8 @@ class Activity(dj.Computed):
         :returns Figure. You can call show() on it.
         :rtype: matplotlib.figure.Figure
         """
+        from scipy.signal import lfilter
+
         ar_rel = Activity.ARCoefficients() & (Activity.Trace() & self)
         if ar_rel:  # if an AR model was used
             # Get some params
@@ -1623,17 +1700,11 @@ class Activity(dj.Computed):
             x_axis = np.arange(num_timepoints) / fps  # make it seconds
 
             # Over each trace
+            impulse = np.zeros(num_timepoints)
+            impulse[0] = 1  # initial spike
             for g in ar_coeffs:
-                AR_order = len(g)
-
-                # Calculate impulse response function
-                irf = np.zeros(num_timepoints)
-                irf[0] = 1  # initial spike
-                for i in range(1, num_timepoints):
-                    if i <= AR_order:  # start of the array needs special care
-                        irf[i] = np.sum(g[:i] * irf[i - 1:: -1])
-                    else:
-                        irf[i] = np.sum(g * irf[i - 1: i - AR_order - 1: -1])
+                # Calculate impulse response function (all-pole filter given by the AR model)
+                irf = lfilter([1], np.concatenate([[1], -np.ravel(g)]), impulse)
 
                 # Plot
                 plt.plot(x_axis, irf)
@@ -1644,7 +1715,7 @@ class Activity(dj.Computed):
     def get_all_spikes(self):
         """ Returns a num_traces x num_timesteps matrix with all spikes."""
         spikes = (Activity.Trace() & self).fetch('trace', order_by='unit_id')
-        return np.array([x.squeeze() for x in spikes])
+        return signal.stack_traces(spikes)
 
 
 @schema
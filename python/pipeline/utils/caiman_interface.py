@@ -218,10 +218,10 @@ def extract_masks(scan, mmap_scan, num_components=200, num_background_components
     log('Done.')
     pool.close()
 
-    # Get results
-    masks = A.reshape((image_height, image_width, -1), order='F') # h x w x num_components
+    # Get results (F-contiguous so flattening masks back to pixels x components is free)
+    masks = np.asfortranarray(A).reshape((image_height, image_width, -1), order='F') # h x w x num_components
     traces = C  # num_components x num_frames
-    background_masks = b.reshape((image_height, image_width, -1), order='F') # h x w x num_components
+    background_masks = np.asfortranarray(b).reshape((image_height, image_width, -1), order='F') # h x w x num_components
     background_traces = f  # num_background_components x num_frames
     raw_traces = C + YrA  # num_components x num_frames
 
@@ -594,8 +594,8 @@ def demix_and_deconvolve_with_cnmf(scan, num_components=200, AR_order=2,
 
     # Reshape spatial matrices to be image_height x image_width x num_frames
     new_shape = (image_height, image_width, -1)
-    location_matrix = location_matrix.toarray().reshape(new_shape, order='F')
-    background_location_matrix = background_location_matrix.reshape(new_shape, order='F')
+    location_matrix = location_matrix.toarray(order='F').reshape(new_shape, order='F')
+    background_location_matrix = np.asfortranarray(background_location_matrix).reshape(new_shape, order='F')
     AR_coefficients = np.array(list(AR_coefficients))  # unwrapping it (num_components x 2)
 
     # Stop ipyparallel cluster
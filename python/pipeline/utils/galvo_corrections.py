@@ -83,34 +83,44 @@ def compute_motion_shifts(scan, template, in_place=True, num_threads=8):
     image_height, image_width, num_frames = scan.shape
     taper = np.outer(signal.tukey(image_height, 0.2), signal.tukey(image_width, 0.2))
 
-    # Prepare fftw
-    frame = pyfftw.empty_aligned((image_height, image_width), dtype='complex64')
-    fft = pyfftw.builders.fft2(frame, threads=num_threads, overwrite_input=in_place,
-                               avoid_copy=True)
-    ifft = pyfftw.builders.ifft2(frame, threads=num_threads, overwrite_input=in_place,
-                                 avoid_copy=True)
-
     # Get fourier transform of template
-    template_freq = fft(template * taper).conj() # we only need the conjugate
+    template_freq = np.fft.fft2(template * taper).conj() # we only need the conjugate
+    template_freq = np.expand_dims(template_freq.astype(np.complex64), -1)
     abs_template_freq = abs(template_freq)
     eps = abs_template_freq.max() * 1e-15
 
+    # Prepare ffts (transform batch_size frames at a time)
+    batch_size = min(num_frames, 16)
+    frames = pyfftw.empty_aligned((image_height, image_width, batch_size), dtype='complex64')
+    fft = pyfftw.builders.fft2(frames, axes=(0, 1), threads=num_threads,
+                               overwrite_input=in_place, avoid_copy=True)
+    ifft = pyfftw.builders.ifft2(frames, axes=(0, 1), threads=num_threads,
+                                 overwrite_input=in_place, avoid_copy=True)
+
     # Compute subpixel shifts per image
     y_shifts = np.empty(num_frames)
     x_shifts = np.empty(num_frames)
-    for i in range(num_frames):
-        # Compute correlation via cross power spectrum
-        image_freq = fft(scan[:, :, i] * taper)
-        cross_power = (image_freq * template_freq) / (abs(image_freq) * abs_template_freq + eps)
-        shifted_cross_power = np.fft.fftshift(abs(ifft(cross_power)))
-
-        # Get best shift
-        shifts = np.unravel_index(np.argmax(shifted_cross_power), shifted_cross_power.shape)
-        shifts = utils._interpolate(shifted_cross_power, shifts, rad=3)
-
-        # Map back to deviations from center
-        y_shifts[i] = shifts[0] - image_height // 2
-        x_shifts[i] = shifts[1] - image_width // 2
+    for start in range(0, num_frames, batch_size):
+        num_batch_frames = min(batch_size, num_frames - start)
+
+        # Compute correlation via cross power spectrum (for all frames in batch)
+        batch = scan[:, :, start: start + num_batch_frames]
+        frames[..., :num_batch_frames] = batch * np.expand_dims(taper, -1)
+        frames[..., num_batch_frames:] = 0
+        image_freq = fft(frames)
+        cross_power = (image_freq * template_freq) / (abs(image_freq) * abs_template_freq +
+                                                      eps)
+        shifted_cross_powers = np.fft.fftshift(abs(ifft(cross_power)), axes=(0, 1))
+
+        for i in range(num_batch_frames):
+            # Get best shift
+            shifted_cross_power = shifted_cross_powers[:, :, i]
+            shifts = np.unravel_index(np.argmax(shifted_cross_power), shifted_cross_power.shape)
+            shifts = utils._interpolate(shifted_cross_power, shifts, rad=3)
+
+            # Map back to deviations from center
+            y_shifts[start + i] = shifts[0] - image_height // 2
+            x_shifts[start + i] = shifts[1] - image_width // 2
 
     return y_shifts, x_shifts
 
@@ -307,8 +317,9 @@ def correct_motion(scan, x_shifts, y_shifts, in_place=True):
     x_clean[np.logical_or(np.isnan(y_shifts), np.isnan(x_shifts))] = 0
 
     # Shift each frame
+    image = np.empty((image_height, image_width), dtype=reshaped_scan.dtype) # reused per frame
     for i, (y_shift, x_shift) in enumerate(zip(y_clean, x_clean)):
-        image = reshaped_scan[:, :, i].copy()
+        np.copyto(image, reshaped_scan[:, :, i])
         ndimage.interpolation.shift(image, (-y_shift, -x_shift), order=1,
                                     output=reshaped_scan[:, :, i])
 
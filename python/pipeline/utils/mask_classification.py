@@ -5,7 +5,8 @@ import numpy as np
 def classify_manual(masks, template):
     """ Opens a GUI that lets you manually classify masks into any of the valid types.
 
-    :param np.array masks: 3-d array of masks (num_masks, image_height, image_width)
+    :param np.array masks: 3-d array of masks (num_masks, image_height, image_width) or any
+        iterable of 2-d masks (image_height, image_width).
     :param np.array template: Image used as background to help with mask classification.
     """
     import matplotlib.pyplot as plt
@@ -14,11 +15,9 @@ def classify_manual(masks, template):
     mask_types= []
     plt.ioff()
     for mask in masks:
-        ir = mask.sum(axis=1) > 0
-        ic = mask.sum(axis=0) > 0
-
-        il, jl = [max(np.min(np.where(i)[0]) - 10, 0) for i in [ir, ic]]
-        ih, jh = [min(np.max(np.where(i)[0]) + 10, len(i)) for i in [ir, ic]]
+        ys, xs = np.nonzero(mask)
+        il, jl = max(ys.min() - 10, 0), max(xs.min() - 10, 0)
+        ih, jh = min(ys.max() + 10, mask.shape[0]), min(xs.max() + 10, mask.shape[1])
         tmp_mask = np.array(mask[il:ih, jl:jh])
 
         with sns.axes_style('white'):
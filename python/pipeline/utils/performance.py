@@ -1,9 +1,28 @@
 import numpy as np
 import multiprocessing as mp
+from scipy import sparse
 from . import galvo_corrections
+import functools
 import time
 
 
+@functools.lru_cache(maxsize=4)
+def read_scan(scan_filename, dtype=np.int16):
+    """ Read the scan header once and reuse it across calls (e.g., fields and channels
+    of the same scan populated one after the other).
+
+    The scan is cached per (scan_filename, dtype) for the lifetime of the process, so a
+    long-running worker will not see changes to a file that was already read (e.g., a
+    scan that was re-exported). Call read_scan.cache_clear() to force a new read.
+
+    :param string scan_filename: Path to the scan (as in scanreader.read_scan).
+    :param type dtype: Data type of the scan data (int16 is the native ScanImage type).
+    """
+    import scanreader
+
+    return scanreader.read_scan(scan_filename, dtype=dtype)
+
+
 def map_frames(f, scan, field_id, channel, y=slice(None), x=slice(None), kwargs={},
                chunk_size_in_GB=0.5, num_processes=10, queue_size=10):
     """ Apply function f to chunks of the scan (divided in the temporal axis).
@@ -91,7 +110,7 @@ def parallel_quality_metrics(chunks, results):
         mean_intensity = np.mean(chunk, axis=(0, 1), dtype=float)
 
         # Contrast
-        percentiles = np.percentile(chunk, q=(1, 99), axis=(0, 1))
+        percentiles = _frame_percentiles(chunk, q=(1, 99))
         contrast = (percentiles[1] - percentiles[0]).astype(float)
 
         # Mean frame
@@ -161,10 +180,9 @@ def parallel_summary_images(chunks, results, raster_phase, fill_fraction, y_shif
         chunk = _correct_field(chunk, raster_phase, fill_fraction, x_shifts[frames],
                                y_shifts[frames])
 
-        # Compute sum and l6-norm
+        # Compute sum and l6-norm (of the scan shifted to start at zero)
         chunk_sum = np.sum(chunk, axis=-1, dtype=float)
-        chunk -= chunk.min()
-        chunk_l6norm = np.sum(chunk**6, axis=-1, dtype=float)
+        chunk_l6norm = _sum_of_sixth_powers(chunk, offset=chunk.min())
 
         # Subtract overall brightness per frame
         chunk -= chunk.mean(axis=(0, 1))
@@ -241,6 +259,7 @@ def parallel_fluorescence(chunks, results, raster_phase, fill_fraction, y_shifts
 
     :returns: (traces x num_frames) array. Traces for each mask in this chunk.
     """
+    masks = None # sparse (num_masks x num_pixels) matrix with normalized mask weights
     while True:
         # Read next chunk (process locks until something can be read)
         frames, chunk = chunks.get()
@@ -256,15 +275,15 @@ def parallel_fluorescence(chunks, results, raster_phase, fill_fraction, y_shifts
         # Prepare some params
         image_height, image_width, num_frames = chunk.shape
         flat_chunk = chunk.reshape(-1, num_frames)
-        num_masks = len(mask_pixels)
 
-        # Extract signal per mask
-        traces = np.zeros([num_masks, num_frames], dtype=np.float32)
-        for i, (mp_, mw) in enumerate(zip(mask_pixels, mask_weights)):
-            mask_as_vector = np.zeros(image_height * image_width, dtype=np.float32)
-            mask_as_vector[np.squeeze(mp_ - 1).astype(int)] = np.squeeze(mw)
-            mask = mask_as_vector.reshape(image_height, image_width, order='F')
-            traces[i] = np.average(flat_chunk, weights=mask.ravel(), axis=0)
+        # Build masks (once, same for all chunks)
+        if masks is None:
+            masks = _sparse_masks(mask_pixels, mask_weights, image_height, image_width)
+            masks = sparse.diags(1 / np.asarray(masks.sum(axis=1)).ravel()).dot(masks)
+            masks = masks.astype(np.float32)
+
+        # Extract signal per mask (weighted average of pixels in each mask)
+        traces = np.asarray(masks.dot(flat_chunk), dtype=np.float32)
 
         # Save results
         results.append((frames, traces))
@@ -298,6 +317,88 @@ def parallel_correct_scan(chunks, results, raster_phase, fill_fraction, y_shifts
         results.append((frames, chunk))
 
 
+def _frame_percentiles(chunk, q):
+    """ Percentiles of each frame (same as np.percentile(chunk, q, axis=(0, 1))).
+
+    Integer chunks (scans read in their native int16) use a histogram of each frame;
+    float chunks are partitioned at only the ranks needed for the linear interpolation.
+
+    :param np.array chunk: (height, width, num_frames) array.
+    :param tuple q: Percentiles to compute (0-100).
+
+    :returns: (len(q), num_frames) array.
+    """
+    frames = chunk.reshape(-1, chunk.shape[-1]).T
+    num_pixels = frames.shape[-1]
+
+    ranks = np.array([p / 100 * (num_pixels - 1) for p in q])
+    lows = np.floor(ranks).astype(int)
+    highs = np.minimum(lows + 1, num_pixels - 1)
+    weights = (ranks - lows)[:, np.newaxis]
+
+    if np.issubdtype(chunk.dtype, np.integer):
+        low_values = np.empty((len(q), len(frames)))
+        high_values = np.empty((len(q), len(frames)))
+        for i, frame in enumerate(frames):
+            min_value = frame.min()
+            cumcounts = np.cumsum(np.bincount(frame.astype(np.intp) - min_value))
+            low_values[:, i] = np.searchsorted(cumcounts, lows, side='right') + min_value
+            high_values[:, i] = np.searchsorted(cumcounts, highs, side='right') + min_value
+    else:
+        frames = np.ascontiguousarray(frames)
+        frames.partition(np.union1d(lows, highs), axis=-1)
+        low_values, high_values = frames[:, lows].T, frames[:, highs].T
+
+    return low_values * (1 - weights) + high_values * weights
+
+
+def _sum_of_sixth_powers(chunk, offset=0, rows_per_block=4):
+    """ Sum of each pixel (minus offset) to the 6th power across time.
+
+    Works on a few rows at a time with two small reusable buffers, so no chunk**6
+    temporary the size of the chunk is ever allocated and the chunk is not modified.
+
+    :param np.array chunk: (height, width, num_frames) float array.
+    :param float offset: Value subtracted from each pixel before raising it.
+    :param int rows_per_block: Number of rows raised to the 6th power at a time.
+
+    :returns: (height, width) array with the sum per pixel (same dtype as chunk).
+
+    ..note:: Sums stay in the chunk dtype; numpy sums the contiguous time axis of the
+        buffer pairwise so the rounding error grows only with log(num_frames).
+    """
+    sixth_sum = np.empty(chunk.shape[:2], dtype=chunk.dtype)
+    squared = np.empty((rows_per_block, *chunk.shape[1:]), dtype=chunk.dtype)
+    sixth = np.empty_like(squared)
+    for i in range(0, chunk.shape[0], rows_per_block):
+        block = chunk[i: i + rows_per_block]
+        sq, sx = squared[:len(block)], sixth[:len(block)]
+        np.subtract(block, offset, out=sq)
+        np.multiply(sq, sq, out=sq)
+        np.multiply(sq, sq, out=sx)
+        np.multiply(sx, sq, out=sx)
+        np.sum(sx, axis=-1, out=sixth_sum[i: i + rows_per_block])
+
+    return sixth_sum
+
+
+def _sparse_masks(mask_pixels, mask_weights, image_height, image_width):
+    """ Sparse (num_masks x num_pixels) matrix with the masks flattened in C order.
+
+    :param list of np.array mask_pixels: Indices where each mask is defined. Indices
+        start at 1 and mask has been flattened using F order (Matlab).
+    :param list of np.array mask_weights: Weights for the indices in mask_pixels.
+    """
+    pixels = [np.ravel(mp_).astype(int) - 1 for mp_ in mask_pixels]
+    mask_ids = np.repeat(np.arange(len(pixels)), [len(mp_) for mp_ in pixels])
+    pixels = np.concatenate(pixels)
+    pixels = (pixels % image_height) * image_width + pixels // image_height # to C order
+    weights = np.concatenate([np.ravel(mw) for mw in mask_weights])
+
+    return sparse.csr_matrix((weights, (mask_ids, pixels)),
+                             shape=(len(mask_pixels), image_height * image_width))
+
+
 def _correct_field(field, raster_phase, fill_fraction, x_shifts, y_shifts):
     """ Correct a single field. Utility function used in some other functions above."""
     field = field.astype(np.float32, copy=False)
@@ -383,7 +484,7 @@ def parallel_quality_stack(chunks, results):
         mean_intensity = np.mean(field, axis=(0, 1), dtype=float)
 
         # Contrast
-        percentiles = np.percentile(field, q=(1, 99), axis=(0, 1))
+        percentiles = _frame_percentiles(field, q=(1, 99))
         contrast = (percentiles[1] - percentiles[0]).astype(float)
 
         # Mean frame
@@ -19,6 +19,7 @@ def compute_quantal_size(scan):
     :returns: np.array noise variances used for the estimation.
     :returns: float the estimated quantal size
     :returns: float the estimated zero value
+    :returns: np.array sum of intensities per pixel (image_height, image_width).
     """
     # Set some params
     num_frames = scan.shape[2]
@@ -27,6 +28,7 @@ def compute_quantal_size(scan):
 
     # Make sure field is at least 32 bytes (int16 overflows if summed to itself)
     scan = scan.astype(np.float32, copy=False)
+    pixel_sum = np.sum(scan, axis=-1, dtype=float)  # so callers can get the mean frame
 
     # Create pixel values at each position in field
     eps = 1e-4 # needed for np.round to not be biased towards even numbers (0.5 -> 1, 1.5 -> 2, 2.5 -> 3, etc.)
@@ -53,7 +55,152 @@ def compute_quantal_size(scan):
                                     minlength=np.ptp(unique_pixels) + 1)[unique_pixels - min_intensity]
     unique_variances = variance_sum / counts # average variance per intensity
 
-    # Compute quantal size (by fitting a linear regressor to predict the variance from intensity)
+    # Compute quantal size
+    quantal_size, zero_level = _fit_quantal_size(unique_pixels, unique_variances)
+
+    return (min_intensity, max_intensity, unique_pixels, unique_variances,
+           quantal_size, zero_level, pixel_sum)
+
+
+def compute_quantal_size_streaming(scan, field_id, channel, frame_start, frame_stop,
+                                   chunk_size=128):
+    """ Same as compute_quantal_size but reads the frames from the scan in temporal
+    chunks so the whole window is never held in memory.
+
+    Pixel counts and variance sums per intensity are accumulated across chunks; the
+    intensity range and the fit are computed once all frames have been seen.
+
+    :param scan: Scan object (from scanreader) or 5-d array (num_fields, image_height,
+        image_width, num_channels, num_frames).
+    :param int field_id: Field to use.
+    :param int channel: Channel to use.
+    :param int frame_start: First frame in the window.
+    :param int frame_stop: Frame after the last frame in the window.
+    :param int chunk_size: Number of frames read at a time.
+
+    :returns: Same as compute_quantal_size.
+    """
+    stats = {}
+    for chunk_start in range(frame_start, frame_stop, chunk_size):
+        # Read one extra frame at the start to form the pair with the previous chunk
+        first_frame = max(chunk_start - 1, frame_start)
+        chunk_stop = min(chunk_start + chunk_size, frame_stop)
+        chunk = scan[field_id, :, :, channel, first_frame: chunk_stop]
+        _update_quantal_stats(stats, chunk, num_old_frames=chunk_start - first_frame)
+
+    return _finish_quantal_size(stats, num_frames=frame_stop - frame_start)
+
+
+def compute_quantal_sizes_streaming(scan, frame_start, frame_stop, chunk_size=32):
+    """ Compute quantal size for every field and channel in the scan reading each chunk
+    of frames only once (rather than once per field and channel).
+
+    All fields need to have the same size (as in resonant scans).
+
+    :param scan: Scan object (from scanreader) or 5-d array (num_fields, image_height,
+        image_width, num_channels, num_frames).
+    :param int frame_start: First frame in the window.
+    :param int frame_stop: Frame after the last frame in the window.
+    :param int chunk_size: Number of frames (of all fields and channels) read at a time.
+
+    :returns: List (one per field) of lists (one per channel) with the results of
+        compute_quantal_size for that field and channel.
+    """
+    stats = None
+    for chunk_start in range(frame_start, frame_stop, chunk_size):
+        # Read one extra frame at the start to form the pair with the previous chunk
+        first_frame = max(chunk_start - 1, frame_start)
+        chunk_stop = min(chunk_start + chunk_size, frame_stop)
+        chunk = scan[:, :, :, :, first_frame: chunk_stop]
+        if stats is None:
+            stats = [[{} for _ in range(chunk.shape[3])] for _ in range(chunk.shape[0])]
+
+        for field_id, field_stats in enumerate(stats):
+            for channel, channel_stats in enumerate(field_stats):
+                _update_quantal_stats(channel_stats, chunk[field_id, :, :, channel],
+                                      num_old_frames=chunk_start - first_frame)
+
+    return [[_finish_quantal_size(channel_stats, num_frames=frame_stop - frame_start)
+             for channel_stats in field_stats] for field_stats in stats]
+
+
+def _update_quantal_stats(stats, chunk, num_old_frames=0):
+    """ Add a chunk of frames to the running statistics used to compute quantal size.
+
+    :param dict stats: Running statistics (empty dict at the start). Modified in place.
+    :param np.array chunk: 3-dimensional chunk (image_height, image_width, num_frames).
+    :param int num_old_frames: Frames at the start of the chunk that were already added
+        (only used to pair them with the new frames).
+    """
+    eps = 1e-4 # needed for np.round to not be biased towards even numbers
+
+    chunk = chunk.astype(np.float32, copy=False)
+    stats['pixel_sum'] = stats.get('pixel_sum', 0) + np.sum(chunk[:, :, num_old_frames:],
+                                                            axis=-1, dtype=float)
+    if chunk.shape[2] < 2:
+        return
+
+    # Pixel values and noise variances at each position in this chunk
+    pixels = np.round((chunk[:, :, :-1] + chunk[:, :, 1:]) / 2 + eps)
+    pixels = pixels.astype(np.int32).ravel()
+    variances = ((chunk[:, :, :-1] - chunk[:, :, 1:]) ** 2 / 2).ravel()
+
+    # Grow the histograms if this chunk has new intensities
+    low, high = pixels.min(), pixels.max()
+    if 'offset' not in stats: # intensity of the first bin in counts/variance_sum
+        stats['offset'] = low
+        stats['counts'] = np.zeros(high - low + 1)
+        stats['variance_sum'] = np.zeros(high - low + 1)
+    elif low < stats['offset'] or high >= stats['offset'] + len(stats['counts']):
+        offset = min(low, stats['offset'])
+        pad = (stats['offset'] - offset,
+               max(high - stats['offset'] - len(stats['counts']) + 1, 0))
+        stats['counts'] = np.pad(stats['counts'], pad, 'constant')
+        stats['variance_sum'] = np.pad(stats['variance_sum'], pad, 'constant')
+        stats['offset'] = offset
+
+    num_bins = len(stats['counts'])
+    stats['counts'] += np.bincount(pixels - stats['offset'], minlength=num_bins)
+    stats['variance_sum'] += np.bincount(pixels - stats['offset'], weights=variances,
+                                         minlength=num_bins)
+
+
+def _finish_quantal_size(stats, num_frames):
+    """ Compute quantal size from the statistics accumulated by _update_quantal_stats.
+
+    :returns: Same as compute_quantal_size.
+    """
+    # Set some params
+    min_count = num_frames * 0.1  # pixel values with fewer appearances will be ignored
+    max_acceptable_intensity = 3000  # pixel values higher than this will be ignored
+
+    # Compute a good range of pixel values (common, not too bright values)
+    counts, variance_sum = stats['counts'], stats['variance_sum']
+    intensities = np.arange(stats['offset'], stats['offset'] + len(counts))
+    min_intensity = min(intensities[counts > min_count])
+    max_intensity = max(intensities[counts > min_count])
+    max_acceptable_intensity = min(max_intensity, max_acceptable_intensity)
+
+    # Select pixels in good range
+    pixels_mask = np.logical_and(intensities >= min_intensity,
+                                 intensities <= max_acceptable_intensity)
+    pixels_mask = np.logical_and(pixels_mask, counts > 0)
+    unique_pixels = intensities[pixels_mask]
+    unique_variances = variance_sum[pixels_mask] / counts[pixels_mask]
+
+    # Compute quantal size
+    quantal_size, zero_level = _fit_quantal_size(unique_pixels, unique_variances)
+
+    return (min_intensity, max_intensity, unique_pixels, unique_variances,
+            quantal_size, zero_level, stats['pixel_sum'])
+
+
+def _fit_quantal_size(unique_pixels, unique_variances):
+    """ Fit a line to predict noise variance from intensity.
+
+    :returns: float the estimated quantal size (slope of the line)
+    :returns: float the estimated zero value (intensity where variance is zero)
+    """
     X = unique_pixels.reshape(-1, 1)
     y = unique_variances
     model = TheilSenRegressor() # robust regression
@@ -61,8 +208,7 @@ def compute_quantal_size(scan):
     quantal_size = model.coef_[0]
     zero_level = - model.intercept_ / model.coef_[0]
 
-    return (min_intensity, max_intensity, unique_pixels, unique_variances,
-           quantal_size, zero_level)
+    return quantal_size, zero_level
 
 
 def find_peaks(trace):
@@ -44,12 +44,25 @@ def mirrconv(signal, f):
 
 
 def float2uint8(scan):
-    """ Converts an scan (or image) from floats to uint8 (preserving the range)."""
+    """ Converts an scan (or image) from floats to uint8 (preserving the range). Constant
+    scans are mapped to all zeros."""
+    if scan.max() == scan.min():
+        return np.zeros(scan.shape, dtype=np.uint8)
     scan = (scan - scan.min()) / (scan.max() - scan.min())
     scan = (scan * 255).astype(np.uint8, copy=False)
     return scan
 
 
+def stack_traces(traces):
+    """ Copy a sequence of (equal length) fetched traces into one float32 num_traces x
+    num_timesteps array."""
+    num_timesteps = traces[0].size if len(traces) > 0 else 0
+    stacked = np.empty([len(traces), num_timesteps], dtype=np.float32)
+    for i, trace in enumerate(traces):
+        stacked[i] = trace.ravel()
+    return stacked
+
+
 def spaced_max(x, min_interval):
     """ Find all local peaks that are at least min_interval indices apart."""
     from scipy.signal import argrelmax
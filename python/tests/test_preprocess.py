@@ -67,6 +67,30 @@ def test_motion_correction_not_in_place():
                     err_msg='Motion correction is not creating a copy of the scan when '
                             'asked to (in_place=False)')
 
+def _shifted_frames(num_frames, image_height=64, image_width=64, seed=0):
+    """ Smooth random template and num_frames crops of the same image shifted by known
+    (integer) pixels."""
+    from scipy import ndimage
+    rng = np.random.RandomState(seed)
+    image = ndimage.gaussian_filter(rng.rand(image_height + 10, image_width + 10), 1)
+    template = image[5: -5, 5: -5]
+    y_shifts = rng.randint(-5, 6, size=num_frames)
+    x_shifts = rng.randint(-5, 6, size=num_frames)
+    scan = np.stack([image[5 - y: 5 - y + image_height, 5 - x: 5 - x + image_width]
+                     for y, x in zip(y_shifts, x_shifts)], axis=-1).astype(np.float32)
+    return scan, template, y_shifts, x_shifts
+
+def test_motion_shifts_batched_match_per_frame():
+    scan, template, y_shifts, x_shifts = _shifted_frames(37)  # not a multiple of 16
+    result = galvo_corrections.compute_motion_shifts(scan, template, in_place=False)
+    desired_result = np.array([galvo_corrections.compute_motion_shifts(scan[:, :, i],
+                               template, in_place=False) for i in range(scan.shape[-1])])
+
+    assert_allclose(result, desired_result[:, :, 0].T, atol=1e-4,
+                    err_msg='Batched motion shifts differ from those computed per frame')
+    assert_allclose(result, [y_shifts, x_shifts], atol=0.25,
+                    err_msg='Motion shifts do not recover the true shifts')
+
 
 ##### Raster correction
 
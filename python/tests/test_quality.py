@@ -0,0 +1,39 @@
+""" Test suite for quality metrics."""
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from pipeline.utils import quality
+
+##### Quantal size
+
+def _poisson_scan(num_fields=2, num_channels=2, num_frames=50, seed=0):
+    """ Poisson scan (num_fields, image_height, image_width, num_channels, num_frames)
+    whose brightness drifts up over time (so later chunks see new intensities)."""
+    rng = np.random.RandomState(seed)
+    rates = rng.uniform(20, 60, size=(num_fields, 16, 16, num_channels, 1))
+    rates = rates + np.arange(num_frames)  # drift
+    return rng.poisson(rates).astype(np.int16)
+
+def _assert_same_quantal_results(result, desired_result, err_msg):
+    for value, desired_value in zip(result[:4], desired_result[:4]):
+        assert_equal(value, desired_value, err_msg=err_msg)
+    assert_allclose(result[4:6], desired_result[4:6], rtol=1e-6, err_msg=err_msg) # fit
+    assert_allclose(result[6], desired_result[6], err_msg=err_msg) # pixel sum
+
+def test_quantal_size_streaming_matches_in_memory():
+    scan = _poisson_scan()
+    for chunk_size in [7, 45, 100]:  # 7 does not divide the 45-frame window
+        result = quality.compute_quantal_size_streaming(scan, 1, 0, 3, 48, chunk_size)
+        desired_result = quality.compute_quantal_size(scan[1, :, :, 0, 3:48])
+        _assert_same_quantal_results(result, desired_result, 'Streaming quantal size '
+                                     'differs from computing it in memory (chunk size '
+                                     '{})'.format(chunk_size))
+
+def test_quantal_sizes_streaming_matches_in_memory():
+    scan = _poisson_scan()
+    results = quality.compute_quantal_sizes_streaming(scan, 3, 48, chunk_size=7)
+    for field_id, field_results in enumerate(results):
+        for channel, result in enumerate(field_results):
+            desired_result = quality.compute_quantal_size(scan[field_id, :, :, channel, 3:48])
+            _assert_same_quantal_results(result, desired_result, 'Streaming quantal size '
+                                         'differs for field {} channel {}'.format(field_id,
+                                                                                  channel))